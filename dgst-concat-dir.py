@@ -1,11 +1,213 @@
 #!/usr/bin/env python3
 
 import argparse
+import fnmatch
+import multiprocessing
 import os
+import re
 import sys
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 from lib import DigestList
 
+
+def scandir(dirpath):
+    """
+    List the given directory and return a (dirnames, filenames) tuple. Relies
+    on the file type reported by os.scandir instead of issuing a stat() call
+    for each entry. Returns None if the directory cannot be read.
+    """
+    dirnames = []
+    filenames = []
+    try:
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    dirnames.append(entry.path)
+                else:
+                    filenames.append(entry.name)
+    except OSError:
+        return None
+    return dirnames, filenames
+
+
+def walk(top, prefetch=8):
+    """
+    Walk the directory tree below `top` breadth first and yield a
+    (dirpath, filenames) tuple for every directory. Up to `prefetch`
+    directories are listed ahead of time by a thread pool, which hides the
+    latency of network filesystems. Symlinks to directories are not followed
+    and unreadable directories are skipped, like os.walk does.
+    """
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        pending = deque([top])
+        listings = deque()
+        while pending or listings:
+            while pending and len(listings) < prefetch:
+                dirpath = pending.popleft()
+                listings.append((dirpath, executor.submit(scandir, dirpath)))
+            dirpath, listing = listings.popleft()
+            result = listing.result()
+            if result is not None:
+                dirnames, filenames = result
+                pending.extend(dirnames)
+                yield dirpath, filenames
+
+
+def uptodate(outpath, dgstfiles):
+    """
+    Return true if the output file exists and is not older than any of the
+    given digest files, nor than the directories containing them. Adding,
+    removing or renaming a digest file touches its directory, hence this also
+    catches files moved in with an old mtime.
+    """
+    try:
+        mtime = outpath.stat().st_mtime_ns
+    except FileNotFoundError:
+        return False
+    paths = set(dgstfiles)
+    paths.add(outpath.parent)
+    paths.update(dgstfile.parent for dgstfile in dgstfiles)
+    return all(path.stat().st_mtime_ns <= mtime for path in paths)
+
+
+def jobcount(value):
+    """
+    Argument type for the number of worker processes, rejects anything below
+    one.
+    """
+    jobs = int(value)
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(f'invalid job count: {value!r}')
+    return jobs
+
+
+class DirectoryConcat(object):
+    """
+    Concatenate the digest files matching the given patterns in one directory
+    and return the output path along with the encoded contents. One instance
+    is handed over to each worker process on startup, hence the class needs to
+    live on module level.
+    """
+
+    def __init__(self, patterns, outname, flag=None, update=False):
+        flags = re.IGNORECASE if os.path.normcase('A') == 'a' else 0
+        self.patterns = patterns
+        # Patterns reaching into subdirectories need a full Path.glob, all
+        # others are matched against the file names of a directory.
+        self.matchers = [
+            None if os.sep in pattern or (os.altsep and os.altsep in pattern)
+            else re.compile(fnmatch.translate(pattern), flags).match
+            for pattern in patterns
+        ]
+        self.outname = outname
+        self.update = update
+        self.digests = DigestList(flat=True, flag=flag)
+
+    def select(self, directory):
+        """
+        Match the digest files of one directory and return an
+        (outpath, matches) tuple, where matches holds a list of digest files
+        per matching pattern. Returns None if the directory can be skipped.
+        """
+        dirpath, filenames = directory
+        outpath = Path(dirpath) / self.outname
+        matches = []
+        for pattern, match in zip(self.patterns, self.matchers):
+            if match is None:
+                dgstfiles = [path for path in Path(dirpath).glob(pattern)
+                             if path != outpath]
+            else:
+                dgstfiles = [Path(dirpath) / name for name in filenames
+                             if name != self.outname and match(name)]
+            if dgstfiles:
+                matches.append(dgstfiles)
+
+        # The output file is generated from the files matching the last
+        # pattern, skip the directory if none of them changed since.
+        if not matches or (self.update and uptodate(outpath, matches[-1])):
+            return None
+
+        return outpath, matches
+
+    def __call__(self, selection):
+        outpath, matches = selection
+
+        # Files matching earlier patterns are parsed nevertheless, such that
+        # errors in them are reported.
+        for dgstfiles in matches[:-1]:
+            for _ in self.digests.join(dgstfiles):
+                pass
+
+        lines = self.digests.format(matches[-1])
+        return outpath, ''.join(lines).encode()
+
+
+_concat = None
+
+
+def init_worker(concat):
+    """
+    Store the DirectoryConcat instance once per worker process, such that
+    only the selected digest files need to be sent along with each task.
+    """
+    global _concat
+    _concat = concat
+
+
+def concat_batch(batch):
+    """
+    Concatenate the digest files of a batch of directories in a worker
+    process. Stops at the first failing directory and returns the exception
+    in place of its result, such that the output of the directories before
+    it is not lost.
+    """
+    results = []
+    for selection in batch:
+        try:
+            results.append(_concat(selection))
+        except Exception as e:
+            results.append(e)
+            break
+    return results
+
+
+def concat_parallel(executor, selections, window, batchsize=16):
+    """
+    Submit the selections to the worker processes in batches through a
+    bounded window of `window` batches and yield the results in order. Raises
+    the exception of the first failing directory.
+    """
+    selections = iter(selections)
+    batches = iter(lambda: list(islice(selections, batchsize)), [])
+    pending = deque()
+
+    def collect(future):
+        for result in future.result():
+            if isinstance(result, Exception):
+                raise result
+            yield result
+
+    try:
+        for batch in batches:
+            pending.append(executor.submit(concat_batch, batch))
+            if len(pending) >= window:
+                yield from collect(pending.popleft())
+        while pending:
+            yield from collect(pending.popleft())
+    finally:
+        # Stop at the first failing directory like a serial run would.
+        for future in pending:
+            future.cancel()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Recursively walk a filesystem hierarchy and concatenate digest files into one file per directory.')
     parser.add_argument('patterns', metavar='PATTERN', type=str, nargs='+',
@@ -14,6 +216,11 @@ if __name__ == "__main__":
             help='print a stacktrace when something goes wrong')
     parser.add_argument('-o', '--outname', type=str,
             help='output file name', default='md5sum')
+    parser.add_argument('-j', '--jobs', type=jobcount,
+            help='number of worker processes, defaults to the number of CPUs')
+    parser.add_argument('-u', '--update', action='store_true',
+            help='only rewrite output files older than any of their digest files '
+                 'or their directories')
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-b', '--binary', action='store_true',
@@ -37,13 +244,32 @@ if __name__ == "__main__":
     if args.text:
         flag = ' '
 
-    for (dirpath, _, _) in os.walk(Path('.')):
-        outpath = Path(dirpath) / args.outname
-        for pattern in args.patterns:
-            dgstfiles = list(Path(dirpath).glob(pattern))
-            while outpath in dgstfiles:
-                dgstfiles.remove(outpath)
-            if dgstfiles:
-                with outpath.open('w') as outfile:
-                    for entry in DigestList(flat=True, flag=flag).join(dgstfiles):
-                        print(f'{entry.digest} {entry.flag}{entry.path}', file=outfile)
+    concat = DirectoryConcat(args.patterns, args.outname, flag, args.update)
+    jobs = args.jobs or os.cpu_count()
+    # Digest files are matched while walking the tree, only directories with
+    # digest files in need of concatenation are handed over to the workers.
+    selections = filter(None, map(concat.select, walk('.')))
+    with ExitStack() as stack:
+        if jobs == 1:
+            results = map(concat, selections)
+        else:
+            # Worker processes are spawned instead of forked, this process is
+            # running the directory walker threads already.
+            context = multiprocessing.get_context('spawn')
+            executor = stack.enter_context(ProcessPoolExecutor(
+                max_workers=jobs, mp_context=context,
+                initializer=init_worker, initargs=(concat,)))
+            results = concat_parallel(executor, selections, 2 * jobs)
+
+        # Output files are written by a couple of threads in the main
+        # process, such that walking, parsing and writing overlap. Output of
+        # directories collected before a failure is still written and write
+        # errors are reported in any case.
+        writer = stack.enter_context(ThreadPoolExecutor(max_workers=4))
+        writes = []
+        try:
+            for outpath, data in results:
+                writes.append(writer.submit(outpath.write_bytes, data))
+        finally:
+            for write in writes:
+                write.result()
@@ -37,6 +37,6 @@ if __name__ == "__main__":
     if args.text:
         flag = ' '
 
+    digests = DigestList(flag=flag)
     for pattern in args.patterns:
-        for entry in DigestList(flag=flag).join(Path('.').glob(pattern)):
-            print(f'{entry.digest} {entry.flag}{entry.path}', file=args.outfile)
+        digests.write(Path('.').glob(pattern), args.outfile)
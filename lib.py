@@ -24,6 +24,29 @@ class DigestFileError(DigestError):
     pass
 
 
+def _first_line(buf: io.BufferedReader) -> str:
+    """
+    Decode the first line of the given buffer without consuming it. Line
+    patterns never span a newline, so there is no need to decode the whole
+    chunk.
+    """
+    chunk = buf.peek()
+    end = chunk.find(b'\n')
+    if end >= 0:
+        chunk = chunk[:end]
+    return chunk.decode(errors='ignore')
+
+
+# Matches wherever a POSIX path in a digest line starts with, contains or ends
+# with an empty or '.' component, i.e., wherever PurePosixPath would normalize
+# the path. Paths are preceded by a space or a flag, hence this may report
+# false positives but never misses a path in need of normalization.
+_UNNORMALIZED_POSIX_PATH = re.compile(r'[ */]\.?(?:/|$)', re.MULTILINE)
+
+_COREUTILS_PATTERN = re.compile(r'([0-9A-Fa-f]+) ([\* ])(.*)')
+_BSD_REVERSED_PATTERN = re.compile(r'([0-9A-Fa-f]+) (.*)')
+
+
 class DigestFileFormat(object):
     """
     Represents a digest text file format used to differentiate between POSIX
@@ -32,24 +55,30 @@ class DigestFileFormat(object):
 
     def __init__(self, linesep: str, pathcls: PurePath):
         self._linesep = linesep
+        self._linesep_bytes = linesep.encode()
         self._pathcls = pathcls
+        self._posix = isinstance(pathcls(), PurePosixPath)
 
     def match(self, buf: io.BufferedReader) -> bool:
         """
         Return true if the file represented by the given buffer has the desired
         line separation.
         """
-        chunk = buf.peek()
-        return self._linesep.encode() in chunk
+        return self._linesep_bytes in buf.peek()
 
-    def text(self, buf: io.BufferedReader) -> None:
+    def text(self, buf: io.BufferedReader) -> list:
         """
-        Generates a list of text lines from the given `buf` with line separator
-        stripped.
+        Returns a list of text lines from the given `buf` with line separator
+        stripped. Digest files are small, hence they are read in one go.
         """
-        with io.TextIOWrapper(buf, newline=self._linesep) as text:
-            for line in text:
-                yield line.rstrip(self._linesep)
+        lines = buf.read().decode().split(self._linesep)
+        if lines[-1] == '':
+            lines.pop()
+        if len(self._linesep) > 1:
+            # Also strip stray separator characters, e.g., '\r' in front of
+            # '\r\n', the same way rstrip(linesep) did for each line.
+            lines = [line.rstrip(self._linesep) for line in lines]
+        return lines
 
     def path(self, path: str) -> PurePath:
         """
@@ -58,6 +87,25 @@ class DigestFileFormat(object):
         """
         return self._pathcls(path)
 
+    def normpath(self, path: str) -> str:
+        """
+        Returns the path in the normalized form of the actual file format.
+        """
+        return str(self._pathcls(path))
+
+    def is_posix(self) -> bool:
+        """
+        Return true if paths of this format follow POSIX conventions.
+        """
+        return self._posix
+
+    def is_native(self, path: PurePath) -> bool:
+        """
+        Return true if the given path has the same flavour as the paths of
+        this format.
+        """
+        return isinstance(path, self._pathcls)
+
 
 class DigestFileFormats(object):
     """
@@ -89,28 +137,75 @@ class DigestLineFormat(object):
 
     def __init__(self, pattern):
         self._pattern = pattern
+        self._multiline_pattern = re.compile(f'^(?:{pattern.pattern})$',
+                                             re.MULTILINE)
+
+    @property
+    def pattern(self) -> re.Pattern:
+        """
+        The compiled regex matching a single line of this format.
+        """
+        return self._pattern
 
     def match(self, buf: io.BufferedReader):
         """
-        Return true if the parser matches the given line.
+        Return true if the parser matches the first line of the given buffer.
         """
-        chunk = buf.peek().decode(errors='ignore')
-        return self._pattern.match(chunk) is not None
+        return self._pattern.match(_first_line(buf)) is not None
 
-    def parse(self, line: str, filefmt: DigestFileFormat) -> DigestEntry:
+    def parse(self, line: str, filefmt: DigestFileFormat, flag: str = None,
+              raw: bool = False) -> DigestEntry:
         """
-        Given a line and a filefmt, return a DigestEntry. Raises
+        Given a line and a filefmt, return a DigestEntry. If `flag` is given,
+        it replaces the flag found in the line. If `raw` is true, the path is
+        returned as found in the line instead of normalized. Raises
         DigestParserError on unexpected input.
         """
         result = self._pattern.match(line)
         if result:
-            return self._construct_entry(result, filefmt)
+            digest, line_flag, path = self._construct_entry(result.groups())
+            return DigestEntry(digest,
+                               line_flag if flag is None else flag,
+                               path if raw else filefmt.normpath(path))
         else:
             raise DigestParserError(f'Unexpected line "{line}"')
 
-    def _construct_entry(self, result: re.Match, filefmt: DigestFileFormat) -> DigestEntry:
+    def parse_lines(self, lines: list, filefmt: DigestFileFormat, flag: str = None,
+                    raw: bool = False):
         """
-        Construct a DigestEntry from a match. Must be implemented by a subclass.
+        Given a list of lines and a filefmt, yield a DigestEntry for each of
+        them. If `flag` is given, it replaces the flag found in the lines. If
+        `raw` is true, paths are returned as found in the lines instead of
+        normalized. All lines are matched in one pass over the joined text,
+        they are only parsed one by one in order to pinpoint unexpected input.
+        """
+        text = '\n'.join(lines)
+        results = self._multiline_pattern.findall(text)
+        if len(results) == len(lines) and text.count('\n') == len(lines) - 1:
+            if flag is None:
+                entries = map(self._construct_entry, results)
+            else:
+                # The digest is always the first group and the path always
+                # the last one, the flag group can be ignored altogether.
+                entries = (DigestEntry(groups[0], flag, groups[-1])
+                           for groups in results)
+            if raw or (filefmt.is_posix() and
+                       _UNNORMALIZED_POSIX_PATH.search(text) is None):
+                # Paths are in normalized form already, skip PurePath.
+                yield from entries
+            else:
+                normpath = filefmt.normpath
+                for digest, line_flag, path in entries:
+                    yield DigestEntry(digest, line_flag, normpath(path))
+        else:
+            parse = self.parse
+            for line in lines:
+                yield parse(line, filefmt, flag, raw)
+
+    def _construct_entry(self, groups: tuple) -> DigestEntry:
+        """
+        Construct a DigestEntry with the path as is from the groups of a match.
+        Must be implemented by a subclass.
         """
         raise NotImplementedError()
 
@@ -119,32 +214,21 @@ class DigestLineFormatCoreutils(DigestLineFormat):
     Digest line parser for GNU coreutils md5sum file format.
     """
     def __init__(self):
-        super().__init__(re.compile(
-            r'(?P<digest>[0-9A-Fa-f]+) (?P<flag>[\* ])(?P<path>.*)'
-        ))
+        super().__init__(_COREUTILS_PATTERN)
 
-    def _construct_entry(self, result: re.Match, filefmt: DigestFileFormat) -> DigestEntry:
-        return DigestEntry(
-            digest=result.group('digest'),
-            flag=result.group('flag'),
-            path=filefmt.path(result.group('path'))
-        )
+    def _construct_entry(self, groups: tuple) -> DigestEntry:
+        return DigestEntry._make(groups)
 
 class DigestLineFormatBSDReversed(DigestLineFormat):
     """
     Digest line parser for reversed BSD md5 file format.
     """
     def __init__(self):
-        super().__init__(re.compile(
-            r'(?P<digest>[0-9A-Fa-f]+) (?P<path>.*)'
-        ))
+        super().__init__(_BSD_REVERSED_PATTERN)
 
-    def _construct_entry(self, result: re.Match, filefmt: DigestFileFormat) -> DigestEntry:
-        return DigestEntry(
-            digest=result.group('digest'),
-            flag=' ',
-            path=filefmt.path(result.group('path'))
-        )
+    def _construct_entry(self, groups: tuple) -> DigestEntry:
+        digest, path = groups
+        return DigestEntry(digest, ' ', path)
 
 class DigestLineFormats(object):
     """
@@ -157,14 +241,27 @@ class DigestLineFormats(object):
 
     candidates = [COREUTILS, BSD_REVERSED]
 
+    def __init__(self):
+        # Try all candidates in one pass using an alternation with one outer
+        # group per candidate. The outer group is the last one closed, hence
+        # Match.lastindex tells which candidate matched first.
+        self._pattern = re.compile('|'.join(
+            f'({candidate.pattern.pattern})' for candidate in self.candidates
+        ))
+        self._groups = {}
+        index = 1
+        for candidate in self.candidates:
+            self._groups[index] = candidate
+            index += candidate.pattern.groups + 1
+
     def guess(self, buf: io.BufferedReader):
         """
         Returns either DigestLineFormats.COREUTILS or
         DigestLineFormats.REVERSE_BSD
         """
-        for candidate in self.candidates:
-            if candidate.match(buf):
-                return candidate
+        result = self._pattern.match(_first_line(buf))
+        if result:
+            return self._groups[result.lastindex]
         else:
             raise DigestFormatError('Failed to detect GNU coreutils or '
                                     'reverse BSD line format')
@@ -183,15 +280,18 @@ class DigestParser(object):
         self,
         lines,
         filefmt: DigestFileFormat = DigestFileFormats.NATIVE,
-        linefmt: DigestLineFormat = DigestLineFormats.COREUTILS
+        linefmt: DigestLineFormat = DigestLineFormats.COREUTILS,
+        flag: str = None,
+        raw: bool = False
     ):
         """
         Iterates through the list of lines and yields a DigestEntry for each of
-        them. Throws a RuntimeException if a line does not match the expected
-        format.
+        them. If `flag` is given, it is used instead of the flag found in the
+        lines. If `raw` is true, paths are yielded as found in the lines
+        instead of normalized. Throws a RuntimeException if a line does not
+        match the expected format.
         """
-        for line in lines:
-            yield linefmt.parse(line, filefmt)
+        yield from linefmt.parse_lines(list(lines), filefmt, flag, raw)
 
 
 class DigestList(object):
@@ -216,25 +316,61 @@ class DigestList(object):
         Walk through the list coreutils digest files and concatenate them.
 
         For each digest encountered in each file, the path is prepended with
-        the path to the enclosing directory.
+        the path to the enclosing directory. Paths are returned as plain
+        strings.
         """
+        isabs = os.path.isabs
         for dgstfile in paths:
             dirname = dgstfile.parent
+            prefix = '' if str(dirname) == os.curdir else str(dirname) + os.sep
             with dgstfile.open('rb') as buf:
                 try:
                     filefmt = self.filefmts.guess(buf)
                     linefmt = self.linefmts.guess(buf)
+                    # Paths of a foreign flavour are joined with PurePath,
+                    # which needs them as found in the file.
+                    foreign = not self.flat and not filefmt.is_native(dirname)
                     entries = self.parser.parse(
                         filefmt.text(buf),
                         filefmt,
-                        linefmt
+                        linefmt,
+                        self.flag,
+                        foreign
                     )
-                    for entry in entries:
-                        yield DigestEntry(
-                                digest=entry.digest,
-                                flag=entry.flag if self.flag is None else self.flag,
-                                path=entry.path if self.flat else dirname / entry.path)
+                    if self.flat:
+                        yield from entries
+                    elif filefmt.is_native(dirname):
+                        # Paths in native format can be prefixed without
+                        # constructing a new PurePath for every entry. Only
+                        # absolute paths and the current directory need the
+                        # PurePath join semantics.
+                        for digest, flag, path in entries:
+                            if path == os.curdir or isabs(path):
+                                path = str(dirname / path)
+                            else:
+                                path = prefix + path
+                            yield DigestEntry(digest, flag, path)
+                    else:
+                        # Build the PurePath from the raw path exactly once.
+                        for digest, flag, path in entries:
+                            yield DigestEntry(
+                                    digest, flag, str(dirname / filefmt.path(path)))
                 except DigestFormatError as e:
                     raise DigestFileError(f'Failed while opening "{dgstfile}", {e}') from e
                 except DigestParserError as e:
                     raise DigestFileError(f'Failed while parsing "{dgstfile}", {e}') from e
+
+    def format(self, paths):
+        """
+        Concatenate the list of digest files and generate a line in coreutils
+        format for each entry.
+        """
+        for digest, flag, path in self.join(paths):
+            yield f'{digest} {flag}{path}\n'
+
+    def write(self, paths, outfile):
+        """
+        Concatenate the list of digest files and write the entries to
+        `outfile` in coreutils format.
+        """
+        outfile.writelines(self.format(paths))